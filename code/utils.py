@@ -1,9 +1,146 @@
-import itertools
+import bisect
+import functools
+import io
 import os
+import threading
+import types
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+
+# On-disk HTTP cache, kept next to this module so it does not depend on the working directory
+_HTTP_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".http_cache")
+
+
+def _make_session():
+    """Build a requests Session with connection pooling and retries for HTTPS. If
+    'requests_cache' is installed, GET responses are also cached on disk for one day.
+    """
+    if requests_cache is not None:
+        session = requests_cache.CachedSession(
+            _HTTP_CACHE_PATH,
+            expire_after=86400,
+            allowable_methods=["GET"],
+            stale_if_error=True,
+        )
+    else:
+        warnings.warn(
+            "'requests_cache' is not installed, so HTTP responses will not be cached. "
+            "Install it with 'pip install requests-cache' to enable caching."
+        )
+        session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session.mount("https://", adapter)
+
+    return session
+
+
+# Shared Session so repeated calls reuse keep-alive connections. Created on first use
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_session():
+    """Return the shared Session, creating it on first use."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = _make_session()
+
+    return _SESSION
+
+
+def set_session(session):
+    """
+    Replace the Session used for HTTP requests (e.g. with a mock in tests).
+
+    Args
+        session: A requests.Session-like object.
+
+    Returns
+        None.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        _SESSION = session
+
+
+# Valid quality elements and their names in the vann-nett API
+_VALID_QE = frozenset({"ecological", "rbsp", "swchemical"})
+_QE_MAP = {
+    "ecological": "ecological",
+    "rbsp": "RBSP",
+    "swchemical": "swChemical",
+}
+
+# Map from vann-nett parameter fields (nested keys joined by '.') to output columns
+_PAR_MAP = {
+    "qualityElementType.parentId": "category",
+    "qualityElementType.id": "element",
+    "parameterType.text": "parameter",
+    "status.text": "status",
+    "eqr": "eqr",
+    "neqr": "neqr",
+    "value": "value",
+    "threshold.refValue": "reference_value",
+    "threshold.unit": "unit",
+    "threshold.statusLimits": "status_limits",
+    "yearFrom": "year_from",
+    "yearTo": "year_to",
+    "sampleCount": "sample_count",
+    "otherSource": "source",
+    "dataQuality.text": "data_quality",
+}
+_PAR_PATHS = tuple((tuple(key.split(".")), col) for key, col in _PAR_MAP.items())
+_PAR_OUT = ("waterbody_id",) + tuple(_PAR_MAP.values())
+
+# Text output columns, stored as Arrow strings when pyarrow is available
+_PAR_TEXT_COLS = (
+    "waterbody_id",
+    "category",
+    "element",
+    "parameter",
+    "status",
+    "unit",
+    "source",
+    "data_quality",
+)
+
+# Sentinel returned by _dig() for missing keys
+_MISSING = object()
+
+
+def _dig(record, path):
+    """Follow a sequence of keys into nested dicts. Returns _MISSING if any key is missing."""
+    for key in path:
+        if not isinstance(record, dict) or key not in record:
+            return _MISSING
+        record = record[key]
+
+    return record
 
 
 def get_data_from_vannnett(wb_id, quality_element):
@@ -16,68 +153,141 @@ def get_data_from_vannnett(wb_id, quality_element):
             'rbsp', 'swchemical'].
 
     Returns
-        DataFrame of water quality data (if available) or None.
+        DataFrame of water quality data (if available) or None. If pyarrow is
+        installed, text columns are Arrow-backed strings (missing values are pd.NA).
+        Numeric columns are always NumPy-backed, with NaN for missing values.
     """
-    valid_elements = ["ecological", "rbsp", "swchemical"]
-    if quality_element.lower() not in valid_elements:
+    qe = quality_element.lower()
+    if qe not in _VALID_QE:
         raise ValueError(
             "'quality_element' must be one of ['ecological', 'rbsp', 'swchemical']."
         )
-
-    element_dict = {
-        "ecological": "ecological",
-        "rbsp": "RBSP",
-        "swchemical": "swChemical",
-    }
-    quality_element = element_dict[quality_element.lower()]
+    quality_element = _QE_MAP[qe]
 
     url = f"https://vann-nett.no/service/waterbodies/{wb_id}/qualityElements/{quality_element}"
-    response = requests.get(url)
+    response = _get_session().get(url, timeout=(5, 30))
     if response.status_code != 200:
         response.raise_for_status()
-    data = response.json()
-
-    par_map = {
-        "qualityElementType.parentId": "category",
-        "qualityElementType.id": "element",
-        "parameterType.text": "parameter",
-        "status.text": "status",
-        "eqr": "eqr",
-        "neqr": "neqr",
-        "value": "value",
-        "threshold.refValue": "reference_value",
-        "threshold.unit": "unit",
-        "threshold.statusLimits": "status_limits",
-        "yearFrom": "year_from",
-        "yearTo": "year_to",
-        "sampleCount": "sample_count",
-        "otherSource": "source",
-        "dataQuality.text": "data_quality",
-    }
-    par_cols = par_map.keys()
-    df_list = []
-    cat_data = pd.json_normalize(data)
-    for cat_row in cat_data.itertuples():
-        ele_data = pd.json_normalize(cat_row.qualityElements)
-        for ele_row in ele_data.itertuples():
-            par_df = pd.json_normalize(ele_row.parameters)
-            if not par_df.empty:
-                par_df = par_df[par_cols].rename(columns=par_map)
-                par_df = par_df.dropna(axis="columns", how="all")
-                df_list.append(par_df)
+    if orjson is not None:
+        data = orjson.loads(response.content)
+    else:
+        data = response.json()
+
+    rows = []
+    for cat in data if isinstance(data, list) else [data]:
+        for ele in cat.get("qualityElements") or []:
+            for par in ele.get("parameters") or []:
+                row = {"waterbody_id": wb_id}
+                for path, col in _PAR_PATHS:
+                    val = _dig(par, path)
+                    if val is not _MISSING:
+                        row[col] = val
+                rows.append(row)
+
+    if len(rows) > 0:
+        df = pd.DataFrame.from_records(rows, columns=_PAR_OUT)
+        if pyarrow is not None:
+            # Only convert columns that actually hold strings. Anything else is left as is
+            str_cols = [
+                col
+                for col in _PAR_TEXT_COLS
+                if pd.api.types.infer_dtype(df[col], skipna=True) == "string"
+            ]
+            df = df.astype({col: "string[pyarrow]" for col in str_cols})
+        return df
+    else:
+        return None
+
+
+def get_data_from_vannnett_many(wb_ids, quality_element, max_workers=16):
+    """
+    Fetches water quality data from the vann-nett service for several waterbodies
+    concurrently. Requests share the module's pooled Session.
+
+    Parameters
+        wb_ids: List of str. The waterbody IDs.
+        quality_element: Str. The quality element to fetch. Must be one of ['ecological',
+            'rbsp', 'swchemical'].
+        max_workers: Int. Maximum number of concurrent requests. Default 16.
 
+    Returns
+        DataFrame of water quality data for all waterbodies with data, or None if
+        no data are available for any of them.
+    """
+    wb_ids = list(wb_ids)
+    if len(wb_ids) == 0:
+        return None
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(wb_ids))) as ex:
+        df_list = list(
+            ex.map(lambda wb_id: get_data_from_vannnett(wb_id, quality_element), wb_ids)
+        )
+
+    df_list = [df for df in df_list if df is not None]
     if len(df_list) > 0:
-        df = pd.concat(df_list, ignore_index=True)
-        for col in par_map.values():
-            if col not in df.columns:
-                df[col] = np.nan
-        df["waterbody_id"] = wb_id
-        df = df[["waterbody_id"] + list(par_map.values())]
-        return df
+        return pd.concat(df_list, ignore_index=True)
     else:
         return None
 
 
+# WFD class names, in order from lowest to highest value
+_WFD_CLASSES = ("High", "Good", "Moderate", "Poor", "Bad")
+_WFD_CLASS_NAMES = np.array(_WFD_CLASSES)
+
+# Parsed class boundaries, keyed by boundary string
+_WFD_BOUNDARY_CACHE = {}
+
+
+def _get_wfd_boundaries(boundary_str):
+    """Parse and check a WFD boundary string. Returns a read-only array of the first
+    four boundaries. Results are cached by boundary string.
+    """
+    boundaries = _WFD_BOUNDARY_CACHE.get(boundary_str)
+    if boundaries is None:
+        boundaries = np.array(boundary_str.split(";"), dtype=float)
+        if len(boundaries) < 4:
+            raise ValueError(
+                f"'boundary_str' must contain at least 4 boundaries: '{boundary_str}'."
+            )
+
+        # Only the first four boundaries are used. Anything above the fourth is 'Bad'
+        boundaries = boundaries[:4].copy()
+        if np.any(np.diff(boundaries) < 0):
+            raise ValueError(
+                f"'boundary_str' must be in ascending order: '{boundary_str}'."
+            )
+        boundaries.setflags(write=False)
+        _WFD_BOUNDARY_CACHE[boundary_str] = boundaries
+
+    return boundaries
+
+
+def get_wfd_class_vec(boundary_str, values):
+    """
+    Determines class names for an array of values based on the given boundary string.
+
+    Args
+        boundary_str: Str. A semi-colon separated string defining class boundaries.
+                      Example: "475.0;650.0;1075.0;1775.0"
+        values: Array-like of floats. The values to be classified. Missing values
+                (NaN, or pd.NA in pandas extension arrays) are classed as 'Bad'.
+
+    Returns
+        Array of str. The class names corresponding to the given values. Each is one
+        of 'High', 'Good', 'Moderate', 'Poor' or 'Bad'.
+    """
+    boundaries = _get_wfd_boundaries(boundary_str)
+    if pd.api.types.is_extension_array_dtype(values):
+        values = values.to_numpy(dtype=float, na_value=np.nan)
+    else:
+        values = np.asarray(values, dtype=float)
+
+    # Values equal to a boundary belong to the class above it (side="right")
+    idx = np.searchsorted(boundaries, values, side="right")
+
+    return _WFD_CLASS_NAMES[idx]
+
+
 def get_wfd_class(boundary_str, value):
     """
     Determines the class name based on the given value and boundary string.
@@ -85,71 +295,119 @@ def get_wfd_class(boundary_str, value):
     Args
         boundary_str: Str. A semi-colon separated string defining class boundaries.
                       Example: "475.0;650.0;1075.0;1775.0"
-        value: Float. The value to be classified.
+        value: Float. The value to be classified. Missing values (NaN or pd.NA) are
+               classed as 'Bad'.
 
     Returns
         Str. The class name corresponding to the given value. One of
         'High', 'Good', 'Moderate', 'Poor' or 'Bad'.
     """
-    # Split the boundary string into a list of float values
-    boundaries = list(map(float, boundary_str.split(";")))
-
-    # Define the class names based on the boundaries
-    class_names = ["High", "Good", "Moderate", "Poor", "Bad"]
-
-    # Determine the class name based on the value
-    if value < boundaries[0]:
-        return class_names[0]
-    elif boundaries[0] <= value < boundaries[1]:
-        return class_names[1]
-    elif boundaries[1] <= value < boundaries[2]:
-        return class_names[2]
-    elif boundaries[2] <= value < boundaries[3]:
-        return class_names[3]
+    boundaries = _get_wfd_boundaries(boundary_str)
+    value = np.nan if value is pd.NA else float(value)
+
+    # NaN compares False with every boundary, so it ends up as 'Bad'
+    return _WFD_CLASSES[bisect.bisect_right(boundaries, value)]
+
+
+def _is_teotil_col(col):
+    """Identify the TEOTIL output columns needed here, i.e. 'regine' and 'accum_*'."""
+    return col == "regine" or col.startswith("accum_")
+
+
+def _get_teotil_convert_options(usecols):
+    """Build pyarrow CSV options that read only 'usecols', with 'regine' as a string
+    and 'accum_*' columns as floats. Otherwise pyarrow would infer the types, so
+    numeric-looking regine IDs would be read as floats and all-empty columns as 'null'.
+    """
+    column_types = {"regine": pyarrow.string()}
+    column_types.update(
+        {col: pyarrow.float64() for col in usecols if col.startswith("accum_")}
+    )
+
+    return pyarrow.csv.ConvertOptions(include_columns=usecols, column_types=column_types)
+
+
+def _get_teotil2_results_for_year(year, reg_id):
+    """Download TEOTIL2 results for a single year and extract 'accum' columns for 'reg_id'."""
+    base_url = f"https://raw.githubusercontent.com/NIVANorge/teotil2/main/data/norway_annual_output_data/teotil2_results_{year}.csv"
+    response = _get_session().get(base_url, timeout=(5, 60))
+    response.raise_for_status()
+    buf = io.BytesIO(response.content)
+    header = pd.read_csv(buf, nrows=0).columns
+    buf.seek(0)
+    usecols = [col for col in header if _is_teotil_col(col)]
+    if pyarrow is not None:
+        convert_options = _get_teotil_convert_options(usecols)
+        df = pyarrow.csv.read_csv(buf, convert_options=convert_options).to_pandas()
     else:
-        return class_names[4]
+        df = pd.read_csv(buf, usecols=usecols, dtype={"regine": str})
+    df = df.loc[df["regine"].values == reg_id].copy()
+    df["regine"] = df["regine"].astype(str)
+    if len(df) == 0:
+        print(f"WARNING: No TEOTIL2 results for {reg_id} in {year}.")
+    df["År"] = year
+    cols = [i for i in df.columns if i.split("_")[0] == "accum"]
+    df = df[["regine", "År"] + cols]
+
+    return df
 
 
 def get_teotil2_results_for_regine(st_yr, end_yr, reg_id):
     """ """
-    df_list = []
-    for year in range(st_yr, end_yr + 1):
-        base_url = f"https://raw.githubusercontent.com/NIVANorge/teotil2/main/data/norway_annual_output_data/teotil2_results_{year}.csv"
-        df = pd.read_csv(base_url)
-        df = df.query("regine == @reg_id").copy()
-        if len(df) == 0:
-            print(f"WARNING: No TEOTIL2 results for {reg_id} in {year}.")
-        df["År"] = year
-        cols = [i for i in df.columns if i.split("_")[0] == "accum"]
-        df = df[["regine", "År"] + cols]
-        df_list.append(df)
-    df = pd.concat(df_list)
+    years = range(st_yr, end_yr + 1)
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(years)))) as ex:
+        df_list = list(
+            ex.map(lambda year: _get_teotil2_results_for_year(year, reg_id), years)
+        )
+    df = pd.concat(df_list, ignore_index=True)
 
     return df
 
 
+@functools.lru_cache(maxsize=4)
+def _load_teotil3_results(st_yr, end_yr, agri_loss_model, nve_data_yr):
+    """Read TEOTIL3 results for all regines, convert to tonnes and split by regine.
+
+    Returns
+        Tuple (empty_df, reg_dict) where 'empty_df' has the output columns but no
+        rows and 'reg_dict' maps regine IDs to dataframes. Results are cached, so
+        the dataframes must not be modified.
+    """
+    csv_path = f"/home/jovyan/shared/common/teotil3/evaluation/teo3_results_nve{nve_data_yr}_{st_yr}-{end_yr}_agri-{agri_loss_model}-loss.csv"
+    header = pd.read_csv(csv_path, nrows=0).columns
+    usecols = [col for col in header if col == "year" or _is_teotil_col(col)]
+    if pyarrow is not None:
+        convert_options = _get_teotil_convert_options(usecols)
+        df = pyarrow.csv.read_csv(csv_path, convert_options=convert_options).to_pandas()
+    else:
+        df = pd.read_csv(csv_path, usecols=usecols, dtype={"regine": str})
+    mask = (df["year"].values >= st_yr) & (df["year"].values <= end_yr)
+    df = df.loc[mask].copy()
+    df["År"] = df["year"]
+    cols = [i for i in df.columns if i.split("_")[0] == "accum"]
+    df = df[["regine", "År"] + cols].copy()
+    kg_cols = [col for col in df.columns if col.endswith("_kg")]
+    df[kg_cols] = df[kg_cols].to_numpy() / 1000
+    df.rename(columns={col: col[:-3] + "_tonnes" for col in kg_cols}, inplace=True)
+    reg_dict = dict(tuple(df.groupby("regine", sort=False)))
+
+    return df.iloc[0:0].copy(), reg_dict
+
+
 def get_teotil3_results_for_regine(st_yr, end_yr, reg_id, agri_loss_model, nve_data_yr):
     """ """
-    df = pd.read_csv(
-        f"/home/jovyan/shared/common/teotil3/evaluation/teo3_results_nve{nve_data_yr}_{st_yr}-{end_yr}_agri-{agri_loss_model}-loss.csv"
+    empty_df, reg_dict = _load_teotil3_results(
+        st_yr, end_yr, agri_loss_model, nve_data_yr
     )
-    df = df.query(
-        "(regine == @reg_id) and (year >= @st_yr) and (year <= @end_yr)"
-    ).copy()
-    if len(df) == 0:
+    df = reg_dict.get(reg_id)
+    if df is None:
         print(f"WARNING: No TEOTIL3 results for {reg_id}.")
-    df["År"] = df["year"]
-    cols = [i for i in df.columns if i.split("_")[0] == "accum"]
-    df = df[["regine", "År"] + cols]
-    for col in df.columns:
-        if col.endswith("_kg"):
-            new_col = col.replace("_kg", "_tonnes")
-            df[new_col] = df[col] / 1000
-            del df[col]
+        df = empty_df
 
-    return df
+    return df.copy()
 
 
+@functools.lru_cache(maxsize=8)
 def get_aggregation_dict_for_columns(par, model="teotil2"):
     """Make a dict mapping TEOTIL column names to summary columns with
     aggregation where necessary.
@@ -158,43 +416,44 @@ def get_aggregation_dict_for_columns(par, model="teotil2"):
         par: Str. Either 'n' or 'p'
 
     Returns
-        Dict with key's equal to output headings and values are lists
-        of columns to aggregate.
+        Read-only dict with key's equal to output headings and values are
+        tuples of columns to aggregate. The result is cached, so it must not
+        be modified.
     """
     assert par in ("n", "p")
     assert model in ("teotil2", "teotil3")
 
     if model == "teotil2":
         agg_dict = {
-            "Akvakultur": [f"accum_aqu_tot-{par}_tonnes"],
-            "Jordbruk": [
+            "Akvakultur": (f"accum_aqu_tot-{par}_tonnes",),
+            "Jordbruk": (
                 f"accum_agri_diff_tot-{par}_tonnes",
                 f"accum_agri_pt_tot-{par}_tonnes",
-            ],
-            "Avløp": [f"accum_ren_tot-{par}_tonnes", f"accum_spr_tot-{par}_tonnes"],
-            "Industri": [f"accum_ind_tot-{par}_tonnes"],
-            "Bebygd": [f"accum_urban_tot-{par}_tonnes"],
-            "Bakgrunn": [f"accum_nat_diff_tot-{par}_tonnes"],
+            ),
+            "Avløp": (f"accum_ren_tot-{par}_tonnes", f"accum_spr_tot-{par}_tonnes"),
+            "Industri": (f"accum_ind_tot-{par}_tonnes",),
+            "Bebygd": (f"accum_urban_tot-{par}_tonnes",),
+            "Bakgrunn": (f"accum_nat_diff_tot-{par}_tonnes",),
         }
     else:
         agg_dict = {
-            "Akvakultur": [f"accum_aquaculture_tot{par}_tonnes"],
-            "Jordbruk": [f"accum_agriculture_tot{par}_tonnes"],
-            "Avløp": [
+            "Akvakultur": (f"accum_aquaculture_tot{par}_tonnes",),
+            "Jordbruk": (f"accum_agriculture_tot{par}_tonnes",),
+            "Avløp": (
                 f"accum_large-wastewater_tot{par}_tonnes",
                 f"accum_spredt_tot{par}_tonnes",
-            ],
-            "Industri": [f"accum_industry_tot{par}_tonnes"],
-            "Bebygd": [f"accum_urban_tot{par}_tonnes"],
-            "Bakgrunn": [
+            ),
+            "Industri": (f"accum_industry_tot{par}_tonnes",),
+            "Bebygd": (f"accum_urban_tot{par}_tonnes",),
+            "Bakgrunn": (
                 f"accum_agriculture-background_tot{par}_tonnes",
                 f"accum_upland_tot{par}_tonnes",
                 f"accum_wood_tot{par}_tonnes",
                 f"accum_lake_tot{par}_tonnes",
-            ],
+            ),
         }
 
-    return agg_dict
+    return types.MappingProxyType(agg_dict)
 
 
 def aggregate_parameters(df, par, model):
@@ -209,9 +468,9 @@ def aggregate_parameters(df, par, model):
         Dataframe.
     """
     agg_dict = get_aggregation_dict_for_columns(par, model=model)
-    for group, cols in agg_dict.items():
-        df[group] = df[cols].sum(axis=1)
+    col_to_group = {col: group for group, cols in agg_dict.items() for col in cols}
+    agg_df = df[list(col_to_group)].T.groupby(col_to_group, sort=False).sum().T
 
-    df = df[["regine", "År"] + list(agg_dict.keys())]
+    df = pd.concat([df[["regine", "År"]], agg_df[list(agg_dict.keys())]], axis=1)
 
     return df
\ No newline at end of file